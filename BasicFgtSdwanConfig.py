@@ -9,7 +9,7 @@ USE AT YOUR OWN RISK!
 This program will use your FortiGate REST API account (with super_admin privileges) to:
 1) Identify your VDOMs and auto-select the (non-root) traffic VDOM if 2 (or hand you the choice if more than 2)
 2) Create an Internet SD-WAN zone on your traffic VDOM.
-3) Add the WAN interface of your choice to the Internet SD-WAN zone.
+3) Add the WAN interface of your choice to the Internet SD-WAN zone (in the same request as step 2).
 4) Configure a static route to your Internet SD-WAN zone.
 
 Set the API_KEY environment variable to your REST API admin key. For example in PowerShell:
@@ -18,20 +18,43 @@ Set the API_KEY environment variable to your REST API admin key. For example in
 
 # Import necessary libraries
 import os
+import argparse
+import hashlib
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
-import ipaddress
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Parse and build the CMDB JSON bodies with orjson if it is installed, with json otherwise
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loadJson(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def dumpJson(obj):
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode()
+
+
+# Accepted form of the management and gateway addresses typed in by the user:
+# four decimal octets of at most 255, without leading zeros
+IPV4_OCTET = r"(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])"
+IPV4_RE = re.compile(rf"{IPV4_OCTET}(?:\.{IPV4_OCTET}){{3}}")
+
 # Function to validate IPv4 address
 
 
 def validateIpv4(ip):
-    try:
-        ipaddress.IPv4Address(ip)
-        return True
-    except ipaddress.AddressValueError:
-        return False
+    return IPV4_RE.fullmatch(ip) is not None
 
 
 def getUserInput():
@@ -62,26 +85,81 @@ def getUserInput():
     return base_url, wan_interface_name, internet_gateway_ip
 
 
-# Get the API key from the environment
-api_key = os.getenv("API_KEY")
-
-# Define the headers for API requests
+# Define the headers for API requests, main() adds the Authorization header from API_KEY
 headers = {
     "Content-Type": "application/json",
-    "Authorization": f"Bearer {api_key}"
+    "Connection": "keep-alive"
 }
 
+# Default (connect, read) timeouts in seconds for every API call
+DEFAULT_TIMEOUT = (5, 60)
+
+# Session that applies DEFAULT_TIMEOUT to every request that doesn't set its own
+
+
+class TimeoutSession(requests.Session):
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+        return super().request(*args, **kwargs)
+
+
+# Share one session across all API calls so the TLS connection is reused
+SESSION = TimeoutSession()
+# Retry failed connections, and 5xx answers to the GET, PUT and DELETE calls, with exponential
+# backoff. urllib3 does not retry the POST that creates the default route on a 5xx answer
+# total=4 means up to 4 retries, so at most 5 attempts per call
+RETRY = Retry(total=4, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504],
+              raise_on_status=False)
+SESSION.mount("https://", HTTPAdapter(pool_connections=32,
+              pool_maxsize=32, max_retries=RETRY))
+SESSION.headers.update(headers)
+SESSION.verify = False
+
+# Cache API responses that rarely change on disk, for this many seconds
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "fortinet-tools")
+VDOM_CACHE_TTL = 3600
+
+# Function to send a GET request, answering from the on-disk cache while it is fresh
+
+
+def cachedGet(url, ttl):
+    cache_file = os.path.join(
+        CACHE_DIR, hashlib.sha256(url.encode()).hexdigest() + ".json")
+    # A TTL of 0 skips the cache lookup, but the fresh response is still stored
+    if ttl > 0:
+        try:
+            if os.path.isfile(cache_file) and os.path.getmtime(cache_file) > time.time() - ttl:
+                with open(cache_file, "rb") as f:
+                    return 200, loadJson(f.read())
+        except (OSError, ValueError):
+            # An unreadable or corrupt cache entry just means asking the FortiGate
+            pass
+
+    response = SESSION.get(url)
+    if response.status_code != 200:
+        return response.status_code, None
+    payload = loadJson(response.content)
+    # Store the raw response body, there is no need to serialize it again
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(f"{cache_file}.tmp", "wb") as f:
+            f.write(response.content)
+        os.replace(f"{cache_file}.tmp", cache_file)
+    except OSError as e:
+        print(f"Warning: unable to cache the response in {CACHE_DIR}: {e}")
+    return response.status_code, payload
+
 # Function to get the correct traffic VDOM name
 
 
-def getTrafficVdomName(base_url, headers):
-    # Send the API request to get all the configured VDOMs
-    response = requests.get(
-        f"{base_url}/cmdb/system/vdom", headers=headers, verify=False)
+def getTrafficVdomName(base_url, cache_ttl=VDOM_CACHE_TTL):
+    # Send the API request to get the names of all the configured VDOMs
+    status_code, payload = cachedGet(
+        f"{base_url}/cmdb/system/vdom?format=name", cache_ttl)
 
     # Check the response
-    if response.status_code == 200:
-        vdoms = response.json()['results']
+    if status_code == 200:
+        vdoms = payload['results']
         if len(vdoms) == 2:
             # If it's only "root" and another one, get the second
             vdom = vdoms[1]['name']
@@ -95,94 +173,110 @@ def getTrafficVdomName(base_url, headers):
             vdom = vdoms[vdom_number-1]['name']
             print(f"The VDOM is set to {vdom}")
     else:
-        print(f"Failed to get the VDOMs. Status code: {response.status_code}")
+        print(f"Failed to get the VDOMs. Status code: {status_code}")
 
     return vdom
 
-# Function to create the Internet SD-WAN zone
-
-
-def createInternetSdwanZone(base_url, headers, vdom):
-    zone_data = {
-        "zone": [{"name": "Internet SD-WAN"}]
-    }
-    response = requests.put(f"{base_url}/cmdb/system/sdwan?vdom={vdom}",
-                            headers=headers, json=zone_data, verify=False)
-    if response.status_code == 200:
-        print("Internet SD-WAN zone created successfully.")
-
-    else:
-        print(
-            f"Failed to create Internet SD-WAN zone. Status code: {response.status_code}")
-
-# Function to add the WAN interface to the Internet SD-WAN zone
+# Function to create the Internet SD-WAN zone and add the WAN interface to it in one request
 
 
-def addInterfaceToSdwanZone(base_url, headers, vdom, wan_interface_name, internet_gateway_ip):
-    interface_data = {
+def createInternetSdwanZone(base_url, vdom, wan_interface_name, internet_gateway_ip):
+    sdwan_data = {
+        "zone": [{"name": "Internet SD-WAN"}],
         "members": [{"interface": wan_interface_name,
                     "zone": "Internet SD-WAN",
                      "gateway": internet_gateway_ip}]
     }
-    response = requests.put(f"{base_url}/cmdb/system/sdwan?vdom={vdom}",
-                            headers=headers, json=interface_data, verify=False)
+    response = SESSION.put(
+        f"{base_url}/cmdb/system/sdwan?vdom={vdom}", data=dumpJson(sdwan_data))
     if response.status_code == 200:
         print(
-            f"{wan_interface_name} interface added to the Internet SD-WAN zone successfully.")
+            f"Internet SD-WAN zone created with the {wan_interface_name} interface successfully.")
     else:
-        print(f"Failed to add {
-              wan_interface_name} interface to the Internet SD-WAN zone. Status code: {response.status_code}")
+        print(f"Failed to create Internet SD-WAN zone with the {wan_interface_name} interface. "
+              f"Status code: {response.status_code}")
+
+# Function to get the static routes of the traffic VDOM
+
+
+def getStaticRoutes(base_url, vdom):
+    # Only ask for the route fields used by configureDefaultRoute to keep the response small
+    response = SESSION.get(
+        f"{base_url}/cmdb/router/static?vdom={vdom}&format=seq_num|dst|comment|sdwan-zone")
+    if response.status_code == 200:
+        return loadJson(response.content)['results']
+    print(
+        f"Failed to get the static routes. Status code: {response.status_code}")
+    return None
+
+# Function to check whether an existing route already has the wanted settings
+
+
+def routeMatches(route, route_data):
+    # Zone entries returned by the API carry extra keys (e.g. q_origin_key), so compare names only
+    zones = [zone.get('name') for zone in route.get('sdwan-zone', [])]
+    wanted_zones = [zone['name'] for zone in route_data['sdwan-zone']]
+    return zones == wanted_zones and route.get('comment') == route_data['comment']
 
 # Function to configure the default static route to the Internet SD-WAN zone
 
 
-def configureDefaultRoute(base_url, headers, vdom):
-    response = requests.get(
-        f"{base_url}/cmdb/router/static?vdom={vdom}", headers=headers, verify=False)
+def configureDefaultRoute(base_url, vdom, routes):
+    default_route = next(
+        (route for route in routes if route['dst'] == "0.0.0.0 0.0.0.0"), None)
+    route_data = {
+        "dst": "0.0.0.0 0.0.0.0",
+        "comment": "Default static route created programmatically.",
+        "sdwan-zone": [{"name": "Internet SD-WAN"}]
+    }
+    if default_route and routeMatches(default_route, route_data):
+        # The default route is already configured as wanted, nothing to change
+        print("Default route already correct; skipping.")
+        return
+    if default_route:
+        # If a default route exists, update it in place
+        response = SESSION.put(
+            f"{base_url}/cmdb/router/static/{default_route['seq_num']}?vdom={vdom}", data=dumpJson(route_data))
+    else:
+        # If no default route exists, create it
+        response = SESSION.post(
+            f"{base_url}/cmdb/router/static?vdom={vdom}", data=dumpJson(route_data))
     if response.status_code == 200:
-        routes = response.json()['results']
-        default_route = next(
-            (route for route in routes if route['dst'] == "0.0.0.0 0.0.0.0"), None)
-        if default_route:
-            # If a default route exists, delete it
-            response = requests.delete(f"{base_url}/cmdb/router/static/{
-                default_route['seq_num']}?vdom={vdom}", headers=headers, verify=False)
-            if response.status_code == 200:
-                print("Default route deleted successfully.")
-            else:
-                print(f"Failed to delete default route. Status code: {
-                    response.status_code}")
-        else:
-            # If no default route exists, create it
-            route_data = {
-                "dst": "0.0.0.0 0.0.0.0",
-                "comment": "Default static route created programmatically.",
-                "sdwan-zone": [{"name": "Internet SD-WAN"}]
-            }
-            response = requests.post(
-                f"{base_url}/cmdb/router/static?vdom={vdom}", headers=headers, json=route_data, verify=False)
-            if response.status_code == 200:
-                print("Default route set on the Internet SD-WAN zone successfully.")
-            else:
-                print(
-                    f"Failed to set default route on the Internet SD-WAN zone. Status code: {response.status_code}")
+        print("Default route set on the Internet SD-WAN zone successfully.")
     else:
-        print(f"Failed to get the static routes. Status code: {
-            response.status_code}")
+        print(
+            f"Failed to set default route on the Internet SD-WAN zone. Status code: {response.status_code}")
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Basic FortiGate SD-WAN configuration")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="ignore cached API responses and query the FortiGate again")
+    args = parser.parse_args()
+
+    # Get the API key from the environment, before asking anything or opening a connection
+    api_key = os.getenv("API_KEY")
+    if not api_key:
+        print("Error: the API_KEY environment variable is required.")
+        exit(1)
+    SESSION.headers["Authorization"] = f"Bearer {api_key}"
+
     # Get initial user input
     base_url, wan_interface_name, internet_gateway_ip = getUserInput()
     # Get the traffic VDOM name
-    vdom = getTrafficVdomName(base_url, headers)
-    # Create the Internet SD-WAN zone
-    createInternetSdwanZone(base_url, headers, vdom)
-    # Add the WAN interface to the Internet SD-WAN zone
-    addInterfaceToSdwanZone(base_url, headers, vdom,
-                            wan_interface_name, internet_gateway_ip)
-    # Configure the default static route
-    configureDefaultRoute(base_url, headers, vdom)
+    vdom = getTrafficVdomName(
+        base_url, cache_ttl=0 if args.no_cache else VDOM_CACHE_TTL)
+    # Fetch the static routes while the SD-WAN zone is being created, they don't depend on it
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        routes_future = executor.submit(getStaticRoutes, base_url, vdom)
+        # Create the Internet SD-WAN zone with the WAN interface as its member
+        createInternetSdwanZone(base_url, vdom,
+                                wan_interface_name, internet_gateway_ip)
+        routes = routes_future.result()
+    # Configure the default static route, once the zone it points to exists
+    if routes is not None:
+        configureDefaultRoute(base_url, vdom, routes)
 
 
 if __name__ == "__main__":
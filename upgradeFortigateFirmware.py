@@ -11,22 +11,180 @@
 
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import argparse
+import binascii
 import csv
-import base64
+import hashlib
+import io
+import json
+import mmap
+import random
 import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Default number of firewalls processed at the same time, can be overridden with UPGRADE_WORKERS
+MAX_PARALLEL_UPGRADES = 8
+
+# Serializes console output from the worker threads
+print_lock = threading.Lock()
+
+# Size of the blocks read from the firmware image while it is being uploaded
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Maximum number of firmware images uploaded at the same time, and how often an upload that
+# could not connect is retried
+MAX_PARALLEL_UPLOADS = 4
+UPLOAD_RETRIES = 3
+upload_slots = threading.BoundedSemaphore(MAX_PARALLEL_UPLOADS)
+
+# Status codes meaning the FortiGate does not take multipart uploads, and the block size used
+# when base64-encoding the image instead (a multiple of 3, so blocks encode without padding)
+MULTIPART_REJECTED_STATUSES = (405, 415)
+BASE64_BLOCK_SIZE = 3 << 20
+
+# Encoded legacy upload bodies on disk, by image filename, shared by all workers
+legacy_bodies = {}
+legacy_bodies_lock = threading.Lock()
+
+# fw_ip values accepted from firewalls.csv: four decimal octets of at most 255, no leading zeros
+IPV4_OCTET = r"(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])"
+IPV4_RE = re.compile(rf"{IPV4_OCTET}(?:\.{IPV4_OCTET}){{3}}")
+
+# Columns read from firewalls.csv, in the order process_firewall expects them
+CSV_FIELDS = ("fgt_name", "fw_ip", "api_token")
+
+# Firmware version in an image filename, e.g. FGT_60F-v7.2.8.F-build1639-FORTINET.out
+VERSION_RE = re.compile(r"v?(\d+\.\d+\.\d+)")
+
+# Cache the available firmware list on disk, for this many seconds
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "fortinet-tools")
+FIRMWARE_CACHE_TTL = 900
+
+# (connect, read) timeouts in seconds for API calls, the firmware upload and the reachability check
+DEFAULT_TIMEOUT = (5, 60)
+UPLOAD_TIMEOUT = (5, 1800)
+PREFLIGHT_TIMEOUT = (2, 3)
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-def get_available_firmware(fw_ip, api_token):
-    # Retrieve the current firmware version and available firmware versions from the FortiGate API
-    url = f"https://{fw_ip}/api/v2/monitor/system/firmware"
-    headers = {"Authorization": "Bearer {}".format(api_token)}
-    response = requests.get(url, headers=headers, verify=False)
+# Retry failed connections, and 5xx answers to idempotent requests, with exponential backoff.
+# Uploads are POSTs with a one-shot stream body, send_with_retry handles those
+# total=4 means up to 4 retries, so at most 5 attempts per call
+RETRY = Retry(total=4, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504], raise_on_status=False)
+
+# orjson speeds up parsing the firmware lists and cache entries, json is used when it isn't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def log(*args, **kwargs):
+    with print_lock:
+        print(*args, **kwargs)
+
+def load_json(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def dump_json(obj):
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode()
+
+def status_url(fw_ip):
+    return f"https://{fw_ip}/api/v2/monitor/system/status"
+
+def firmware_upgrade_url(fw_ip):
+    return f"https://{fw_ip}/api/v2/monitor/system/firmware/upgrade"
+
+class TimeoutSession(requests.Session):
+    # Session that applies DEFAULT_TIMEOUT to every request that doesn't set its own
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+        return super().request(*args, **kwargs)
+
+def create_session(api_token, fw_ip):
+    # Build a keep-alive session for one FortiGate. The firmware query and configuration backup share
+    # one TLS connection, the preflight and upload another
+    session = TimeoutSession()
+    session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=RETRY))
+    # The reachability preflight must make a single attempt, and send_with_retry decides when an upload
+    # may be resent, so neither goes through the retrying adapter. They share one no-retry adapter, so
+    # the connection opened by the preflight is reused by the upload
+    no_retry = HTTPAdapter(max_retries=0)
+    session.mount(status_url(fw_ip), no_retry)
+    session.mount(firmware_upgrade_url(fw_ip), no_retry)
+    session.headers.update({
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_token}",
+        "Connection": "keep-alive"
+    })
+    session.verify = False
+    return session
+
+def cache_path(url):
+    return os.path.join(CACHE_DIR, hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+def invalidate_cache(url):
+    # Drop the cached response for url, e.g. once the state it describes has changed
+    try:
+        os.remove(cache_path(url))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        log(f"Warning: unable to remove the cached response for {url}: {e}")
+
+def cached_get(session, url, ttl):
+    # Send a GET request, answering from the on-disk cache while it is fresh
+    cache_file = cache_path(url)
+    # A TTL of 0 skips the cache lookup, but the fresh response is still stored
+    if ttl > 0:
+        try:
+            if os.path.isfile(cache_file) and os.path.getmtime(cache_file) > time.time() - ttl:
+                with open(cache_file, "rb") as f:
+                    return 200, load_json(f.read())
+        except (OSError, ValueError):
+            # An unreadable or corrupt cache entry just means asking the FortiGate
+            pass
+
+    response = session.get(url)
     if response.status_code != 200:
-        print(f"Error: unable to retrieve firmware versions from FortiGate API for firewall at {fw_ip}")
+        return response.status_code, None
+    payload = load_json(response.content)
+    # Write the raw body to a per-thread temporary file first so concurrent workers never see a partial entry
+    tmp_file = f"{cache_file}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp_file, "wb") as f:
+            f.write(response.content)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        log(f"Warning: unable to cache the response for {url} in {CACHE_DIR}: {e}")
+    return response.status_code, payload
+
+def is_reachable(session, fw_ip):
+    # Cheap preflight with short timeouts, so an unreachable firewall is skipped before any heavy work
+    # create_session sends this through its no-retry adapter, so a dead host costs one short timeout
+    try:
+        return session.get(status_url(fw_ip), timeout=PREFLIGHT_TIMEOUT).status_code < 500
+    except requests.RequestException:
+        return False
+
+def firmware_list_url(fw_ip):
+    return f"https://{fw_ip}/api/v2/monitor/system/firmware"
+
+def get_available_firmware(session, fw_ip, cache_ttl=FIRMWARE_CACHE_TTL):
+    # Retrieve the current firmware version and available firmware versions from the FortiGate API
+    url = firmware_list_url(fw_ip)
+    status_code, firmware_json = cached_get(session, url, cache_ttl)
+    if status_code != 200:
+        log(f"Error: unable to retrieve firmware versions from FortiGate API for firewall at {fw_ip}")
         return None, None
-    firmware_json = response.json()
     current_firmware = firmware_json["results"]["current"]["version"]
     available_firmware = []
     for fw in firmware_json["results"]["available"]:
@@ -40,37 +198,148 @@ def get_available_firmware(fw_ip, api_token):
             available_firmware.append(firmware_dict)
     return current_firmware, available_firmware   
 
-def print_firmware_options(current_firmware, available_firmware):
-    # Print a numbered list of available firmware versions
-    print("Firmware Versions:\n")
-    print(f"0. Current Version: {current_firmware}")
+def print_firmware_options(current_firmware, available_firmware, fgt_name, fw_ip):
+    # Print a numbered list of available firmware versions, as one block so other workers can't interleave,
+    # headed by the firewall it belongs to
+    lines = [f"Firmware Versions for {fgt_name} ({fw_ip}):\n", f"0. Current Version: {current_firmware}"]
     for i, fw in enumerate(available_firmware):
-        print(f"{i+1}. Version: {fw['version']}, Build: {fw['build']}, Release Type: {fw['release-type']}, Maturity: {fw['maturity']}")
+        lines.append(f"{i+1}. Version: {fw['version']}, Build: {fw['build']}, Release Type: {fw['release-type']}, Maturity: {fw['maturity']}")
+    log("\n".join(lines))
 
 def display_firmware():
     current_firmware, available_firmware = get_available_firmware()
     print_firmware_options(current_firmware, available_firmware)
 
-def upload_firmware(fw_ip, api_token, filename):
-    # Upload the firmware image to the FortiGate device
-    url = f"https://{fw_ip}/api/v2/monitor/system/firmware/upgrade"
-    headers = {"Authorization": f"Bearer {api_token}", "Content-Type": "application/json"}
-    data = {
-        "source": "upload",
-        "file_content": base64.b64encode(open(filename, "rb").read()).decode(),
-        "filename": os.path.basename(filename)
-    }
-    response = requests.post(url, headers=headers, json=data, verify=False)
+class MultipartFileStream:
+    # multipart/form-data request body that streams a file from disk instead of loading it in memory
+    def __init__(self, filename, fields, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.boundary = uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        head = "".join(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            for name, value in fields.items()
+        )
+        head += (f'--{self.boundary}\r\nContent-Disposition: form-data; name="file"; '
+                 f'filename="{os.path.basename(filename)}"\r\nContent-Type: application/octet-stream\r\n\r\n')
+        tail = f"\r\n--{self.boundary}--\r\n"
+        self._length = len(head.encode()) + os.path.getsize(filename) + len(tail.encode())
+        self._parts = [io.BytesIO(head.encode()), open(filename, "rb"), io.BytesIO(tail.encode())]
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        # Read up to size bytes, moving on to the next part when the current one is exhausted
+        chunks = []
+        while self._parts and (size < 0 or size > 0):
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0).close()
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        for part in self._parts:
+            part.close()
+        self._parts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def never_sent(error):
+    # True when the connection could not be opened at all, so no part of the request left this host
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+def send_with_retry(send):
+    # Call send(), retrying with backoff only when the upload provably never reached the FortiGate.
+    # Anything else (read timeout, aborted connection) may come after the image was delivered and
+    # the upgrade started, so resending could trigger a second upgrade
+    for attempt in range(UPLOAD_RETRIES + 1):
+        try:
+            return send()
+        except requests.ConnectionError as e:
+            if attempt == UPLOAD_RETRIES or not never_sent(e):
+                raise
+            # Exponential backoff with jitter before the next attempt
+            time.sleep(2 ** attempt + random.random())
+
+def post_multipart_firmware(session, url, filename):
+    # The stream is consumed by each attempt, so build a fresh one every time
+    with MultipartFileStream(filename, {"source": "upload"}) as body:
+        return session.post(url, data=body, headers={"Content-Type": body.content_type},
+                            timeout=UPLOAD_TIMEOUT)
+
+def encode_firmware_json(filename):
+    # Write the legacy JSON upload body to a temporary file and return its path. The image is
+    # base64-encoded once per run, block by block from a memory map, and the file is shared by
+    # every firewall that falls back, so memory use stays at one block whatever the image size
+    with legacy_bodies_lock:
+        path = legacy_bodies.get(filename)
+        if path is None:
+            body = tempfile.NamedTemporaryFile("wb", suffix=".json", delete=False)
+            try:
+                with body:
+                    body.write(b'{"source":"upload","filename":')
+                    body.write(dump_json(os.path.basename(filename)))
+                    body.write(b',"file_content":"')
+                    with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        for offset in range(0, len(mm), BASE64_BLOCK_SIZE):
+                            body.write(binascii.b2a_base64(mm[offset:offset + BASE64_BLOCK_SIZE], newline=False))
+                    body.write(b'"}')
+            except BaseException:
+                # Don't leave a partial body, about 1.33x the image size, behind (e.g. on ENOSPC)
+                os.remove(body.name)
+                raise
+            path = legacy_bodies[filename] = body.name
+        return path
+
+def post_json_firmware(session, url, filename):
+    # Each attempt streams the shared encoded body through its own file handle
+    with open(encode_firmware_json(filename), "rb") as body:
+        return session.post(url, data=body, timeout=UPLOAD_TIMEOUT)
+
+def upload_firmware(session, fw_ip, filename):
+    # Upload the firmware image to the FortiGate device, streaming it from disk as multipart/form-data
+    url = firmware_upgrade_url(fw_ip)
+    with upload_slots:
+        response = send_with_retry(lambda: post_multipart_firmware(session, url, filename))
+        if response.status_code in MULTIPART_REJECTED_STATUSES:
+            # Older FortiOS releases only accept the image base64-encoded in a JSON body
+            response = send_with_retry(lambda: post_json_firmware(session, url, filename))
     if response.status_code != 200:
-        print(f"Error: unable to upload firmware image to FortiGate device at {fw_ip}")
+        log(f"Error: unable to upload firmware image to FortiGate device at {fw_ip}")
         return None
-    response_json = response.json()
+    # The cached current and available versions are stale once the upgrade has started
+    invalidate_cache(firmware_list_url(fw_ip))
+    response_json = load_json(response.content)
     return response_json.get("file_id")
 
+def validate_ipv4(ip):
+    return IPV4_RE.fullmatch(ip) is not None
+
 def parse_version_from_filename(filename):
     # Extract the version number from the filename using regex
-    pattern = r"v?(\d+\.\d+\.\d+)"
-    match = re.search(pattern, filename)
+    match = VERSION_RE.search(filename)
     if match:
         # Add the 'v' character to the beginning of the version number
         version = "v" + match.group(1)
@@ -78,24 +347,90 @@ def parse_version_from_filename(filename):
     else:
         return None
 
-def save_configuration(fgt_name, fw_ip, api_token):
+def save_configuration(session, fgt_name, fw_ip):
     # Retrieve the configuration file from the FortiGate device and save it to a local file
     url = f"https://{fw_ip}/api/v2/monitor/system/config/backup"
-    headers = {"Authorization": f"Bearer {api_token}", "Content-Type": "application/json"}
     data = {
         "destination": "file",
         "scope": "global",
     }
-    response = response = requests.post(url, headers=headers, json=data, verify=False)
-    if response.status_code != 200:
-        print(f"Error: unable to retrieve configuration file from FortiGate {fgt_name} at {fw_ip}")
-        return None
-    filename = f"{fgt_name}-{fw_ip}-config-backup.conf"
-    with open(filename, "w") as f:
-        f.write(response.text)
-    print(f"Configuration file saved to {filename}")
+    # Stream the (possibly gzip-encoded) backup straight into the file instead of building it in memory
+    with session.post(url, data=dump_json(data), stream=True) as response:
+        if response.status_code != 200:
+            log(f"Error: unable to retrieve configuration file from FortiGate {fgt_name} at {fw_ip}")
+            return None
+        filename = f"{fgt_name}-{fw_ip}-config-backup.conf"
+        response.raw.decode_content = True
+        # Write next to the target and only replace the previous backup once the new one is complete,
+        # so a dropped connection or decoding error never leaves a truncated backup behind
+        tmp = tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(os.path.abspath(filename)),
+                                          prefix=f".{filename}.", suffix=".tmp", delete=False)
+        try:
+            with tmp:
+                shutil.copyfileobj(response.raw, tmp)
+            os.replace(tmp.name, filename)
+        except BaseException:
+            os.remove(tmp.name)
+            raise
+    log(f"Configuration file saved to {filename}")
+
+def process_firewall(fgt_name, fw_ip, api_token, version, filename, cache_ttl=FIRMWARE_CACHE_TTL):
+    # Run the firmware query, configuration backup and upload pipeline for one firewall
+    if not (fgt_name and fw_ip and api_token):
+        log(f"Error: Missing information for firewall '{fgt_name}' in firewalls.csv")
+        return
+    if not validate_ipv4(fw_ip):
+        log(f"Error: Invalid IPv4 address '{fw_ip}' for firewall '{fgt_name}' in firewalls.csv")
+        return
+
+    # Reuse one session (and TLS connection) for all calls to this firewall
+    with create_session(api_token, fw_ip) as session:
+        # Check if the current firewall is the one we want to upgrade
+        log(f"\nConnecting to {fgt_name} ({fw_ip})...\n")
+        if not is_reachable(session, fw_ip):
+            log(f"Error: {fgt_name} ({fw_ip}) is not reachable, skipping it.")
+            return
+        try:
+            current_firmware, available_firmware = get_available_firmware(session, fw_ip, cache_ttl)
+        except Exception as e:
+            log(f"Error: Unable to connect to {fgt_name} ({fw_ip}). Exception: {e}")
+            return
+        if available_firmware is None:
+            return
+
+        print_firmware_options(current_firmware, available_firmware, fgt_name, fw_ip)
+        available_versions = {fw['version'] for fw in available_firmware}
+
+        if version in available_versions:
+            # Save current global configuration
+            save_configuration(session, fgt_name, fw_ip)
+
+            log(f"\nFirmware upgrade started for {fgt_name}. Filename: {filename}")
+
+            # Upgrade firmware using the given filename
+            try:
+                file_id = upload_firmware(session, fw_ip, filename)
+            except Exception as e:
+                log(f"Error: Unable to upgrade firmware on {fgt_name} ({fw_ip}). Exception: {e}")
+                return
+
+            log(f"Firmware upgrade completed for {fgt_name}.\n")
+        else:
+            log(f"Error: Firmware version {version} not found for {fgt_name}.\n")
 
 def main():
+    parser = argparse.ArgumentParser(description="FortiGate firewall firmware upgrade script")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="ignore cached firmware lists and query every FortiGate again")
+    args = parser.parse_args()
+    cache_ttl = 0 if args.no_cache else FIRMWARE_CACHE_TTL
+
+    workers = os.getenv("UPGRADE_WORKERS", str(MAX_PARALLEL_UPGRADES))
+    if not workers.isdecimal() or int(workers) < 1:
+        print(f"Error: UPGRADE_WORKERS must be a positive whole number, not '{workers}'.")
+        exit(1)
+    workers = int(workers)
+
     print("FortiGate firewall firmware upgrade script\n")
     filename = input("Enter the filename of the firmware image to upgrade to: ")
     version = parse_version_from_filename(filename)
@@ -103,48 +438,38 @@ def main():
         print("Error: Unable to extract firmware version from filename.")
         exit(1)
 
+    # Check the local files before opening any connection
+    for path in (filename, 'firewalls.csv'):
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            print(f"Error: {path} does not exist or is empty.")
+            exit(1)
+
     # Read the firewall IP and API token from the CSV file
     with open('firewalls.csv', 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            fgt_name = row['fgt_name']
-            fw_ip = row['fw_ip']
-            api_token = row['api_token']
-            if not (fgt_name and fw_ip and api_token):
-                print(f"Error: Missing information for firewall '{fgt_name}' in firewalls.csv")
-                continue
-            
-            # Check if the current firewall is the one we want to upgrade
-            print(f"\nConnecting to {fgt_name} ({fw_ip})...\n")
-            try:
-                current_firmware, available_firmware = get_available_firmware(fw_ip, api_token)
-            except Exception as e:
-                print(f"Error: Unable to connect to {fgt_name} ({fw_ip}). Exception: {e}")
-                continue
-            
-            print_firmware_options(current_firmware, available_firmware)
-            version_found = False
-            for fw in available_firmware:
-                if fw['version'] == version:
-                    version_found = True
-                    break
-            
-            if version_found:
-                # Save current global configuration                                
-                save_configuration(fgt_name, fw_ip, api_token)
-                
-                print(f"\nFirmware upgrade started for {fgt_name}. Filename: {filename}")
-                
-                # Upgrade firmware using the given filename
+        reader = csv.reader(csvfile)
+        header = next(reader, [])
+        try:
+            columns = [header.index(field) for field in CSV_FIELDS]
+        except ValueError:
+            print(f"Error: firewalls.csv must have these fields: {','.join(CSV_FIELDS)}")
+            exit(1)
+        # Keep each firewall as a (fgt_name, fw_ip, api_token) tuple, missing trailing values become ""
+        rows = [tuple(record[i] if i < len(record) else "" for i in columns) for record in reader if record]
+
+    # Upgrade the firewalls concurrently, at most workers at a time
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(process_firewall, *row, version, filename, cache_ttl): row for row in rows}
+            for future in as_completed(futures):
+                fgt_name, fw_ip, _ = futures[future]
                 try:
-                    file_id = upload_firmware(fw_ip, api_token, filename)
+                    future.result()
                 except Exception as e:
-                    print(f"Error: Unable to upgrade firmware on {fgt_name} ({fw_ip}). Exception: {e}")
-                    continue
-                
-                print(f"Firmware upgrade completed for {fgt_name}.\n")
-            else:
-                print(f"Error: Firmware version {version} not found for {fgt_name}.\n")
+                    log(f"Error: Upgrade failed for {fgt_name} ({fw_ip}). Exception: {e}")
+    finally:
+        # Remove the encoded legacy upload bodies
+        for path in legacy_bodies.values():
+            os.remove(path)
 
 if __name__ == '__main__':
     main()